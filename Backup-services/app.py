@@ -1,21 +1,150 @@
+"""Back up a PostgreSQL database to Google Cloud Storage.
+
+Runs once from the command line, or as a small Flask service (when PORT is
+set) that performs a backup on every request to /backup.
+
+Environment variables:
+    DATABASE_URL: Database URL/URI passed to pg_dump.
+    DATABASE_URLS: Newline-separated URLs or libpq conninfo strings to back up
+        several databases in one run; overrides DATABASE_URL. Commas are not
+        separators, since multi-host URIs (postgresql://h1:5432,h2:5432/db) use
+        them. The n-th is stored under <prefix>/<database name>/, or under
+        <prefix>/<database name>-<n>/ if several share that name, and under
+        <prefix>/database-<n>/ when no database name can be read from it.
+    BACKUP_CONCURRENCY: Databases backed up at the same time (default 4); upload memory
+        (see GCS_PARALLEL_UPLOAD_WORKERS) is needed once per concurrent backup.
+    BUCKET_NAME: Destination GCS bucket.
+    BACKUP_PREFIX: Optional path prefix inside the bucket.
+    BACKUP_COMPRESS: Compress the dump before upload (default on; legacy alias COMPRESS).
+    BACKUP_COMPRESSOR: "gzip" (default, .sql.gz) or "zstd" (.sql.zst, multithreaded,
+        requires the zstandard package).
+    BACKUP_GZIP_LEVEL: Gzip compression level, 0-9 (default 1). Level 1 is several
+        times faster than the zlib default for only slightly larger pg_dump output;
+        raise it when bucket storage matters more than backup time. Levels 1-3 use
+        python-isal (ISA-L) when it is installed; level 0 stores the dump uncompressed.
+    BACKUP_ZSTD_LEVEL: Zstandard compression level, 1-19 (default 3).
+    BACKUP_EXTERNAL_COMPRESSOR: Compress with the pigz / zstd CLI reading pg_dump's
+        pipe directly instead of in Python (default off). Falls back to in-process
+        compression when the binary is not on PATH.
+    BACKUP_PG_DUMP_FORMAT: "plain" (default, SQL script), "custom" (pg_dump -Fc, a
+        compressed .dump archive for pg_restore) or "directory" (pg_dump -Fd run with
+        parallel jobs into a temp dir, uploaded as a .tar). Archive formats are
+        compressed by pg_dump itself using the BACKUP_COMPRESSOR/level settings;
+        zstd there needs pg_dump 16+.
+    BACKUP_PG_DUMP_JOBS: Parallel pg_dump jobs for the directory format (default: CPU count).
+    BACKUP_TMPDIR: Scratch directory for the directory-format dump and pg_dump's
+        captured stderr (default: the system temp dir); created if missing. Point it
+        at tmpfs, e.g. /dev/shm/backup, to keep the dump off disk entirely. The
+        whole dump must then fit in RAM, and Docker's /dev/shm defaults to 64 MiB
+        (raise it with --shm-size).
+    GCS_CHUNK_SIZE_MIB: Resumable upload chunk size in MiB (default 64). Each chunk is
+        held in memory, so larger values trade RAM for fewer upload round trips.
+        Only used when composite uploads are off (the default): with them on,
+        backups under the threshold and composite parts are sent in part-sized
+        chunks instead.
+    GCS_PARALLEL_UPLOAD_THRESHOLD_MIB: Backups larger than this are uploaded as
+        parallel parts and composed into one object, like gsutil's
+        parallel_composite_upload_threshold (default 0, off; 150 is a good value).
+        Up to this much of the dump is buffered in memory to decide. Composite
+        objects have no MD5 hash, and on Nearline/Coldline/Archive buckets the
+        deleted temporary parts incur early-deletion charges.
+    GCS_PARALLEL_UPLOAD_PART_MIB: Initial size of each parallel part in MiB (default 32).
+        Parts double in size every 32 parts, up to 64 MiB (or this value if larger),
+        so very large dumps need fewer requests and compose levels.
+    GCS_PARALLEL_UPLOAD_WORKERS: Parts uploaded concurrently (default 8). Each holds
+        one part in memory, so a composite upload needs about (workers + 1) * part
+        size: 288 MiB with the defaults, up to 576 MiB once parts reach 64 MiB.
+    PG_DUMP_PATH: pg_dump executable (default "pg_dump").
+    BACKUP_TIMEOUT_SECONDS: Optional deadline in seconds (default: none). A streamed
+        dump only advances as fast as the upload drains the pipe, so for the plain
+        and custom formats it covers dump and upload together and is off unless
+        set. For the directory format it bounds the pg_dump run alone, which
+        keeps its 600 second limit when this is unset or 0.
+    BACKUP_API_KEY: If set, /backup requires a matching X-Backup-Token header.
+    BACKUP_ASYNC: If set, /backup queues the backup and answers 202 with a job id
+        right away; poll GET /backup/<job_id> for the result. One backup job runs
+        at a time: a trigger while one is queued or running answers 409 with that
+        job's id, so retrying schedulers do not pile up duplicates. On Cloud Run
+        this needs CPU to stay allocated outside requests.
+"""
+import contextlib
+import functools
+import io
 import os
+import shutil
 import subprocess
 import tempfile
-import gzip
-import shutil
+import threading
+import time
+import zlib
 import logging
+import re
 import uuid
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
 from datetime import datetime, timezone
+from typing import Optional
+from urllib.parse import unquote, urlparse
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
+from requests.adapters import HTTPAdapter
 from flask import Flask, jsonify
 from flask import request
 from dotenv import load_dotenv
 
+try:
+    # ISA-L's SIMD deflate/CRC32 is several times faster than stock zlib at the same format.
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
 
 # Load environment variables from .env if present
 load_dotenv()
 
+# Limit on a pg_dump run that writes locally (the directory format), as before streaming.
+_PG_DUMP_TIMEOUT_SECONDS = 600
+# Feed the compressor 1 MiB at a time: far fewer deflate()/compress() calls per MB
+# than the 64 KiB a pipe hands back per read.
+_READ_SIZE = 1 << 20
+# zlib wbits value that selects a gzip header/trailer, i.e. a regular .gz file.
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+_DEFAULT_GZIP_LEVEL = 1
+# Compression levels handed to ISA-L; outside them we use zlib. ISA-L's level 0 still
+# compresses, whereas zlib's level 0 stores, so 0 stays with zlib to keep its meaning.
+_ISAL_LEVELS = range(1, 4)
+_DEFAULT_ZSTD_LEVEL = 3
+# Highest regular zstd level; the CLI needs --ultra above it and negative levels need --fast.
+_ZSTD_MAX_LEVEL = 19
+_COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+_CONTENT_TYPES = {None: "application/sql", "gzip": "application/gzip", "zstd": "application/zstd"}
+_EXTERNAL_COMPRESSORS = {"gzip": "pigz", "zstd": "zstd"}
+_DUMP_FORMATS = ("plain", "custom", "directory")
+# Archive formats are compressed by pg_dump, so the object is uploaded as-is.
+_ARCHIVE_SUFFIXES = {"custom": ".dump", "directory": ".tar"}
+_ARCHIVE_CONTENT_TYPES = {"custom": "application/octet-stream", "directory": "application/x-tar"}
+_DEFAULT_GCS_CHUNK_SIZE_MIB = 64
+_DEFAULT_PARALLEL_UPLOAD_THRESHOLD_MIB = 0
+_DEFAULT_PARALLEL_UPLOAD_PART_MIB = 32
+_DEFAULT_PARALLEL_UPLOAD_WORKERS = 8
+_DEFAULT_BACKUP_CONCURRENCY = 4
+# requests' own default connection pool size per host.
+_MIN_HTTP_POOL_SIZE = 10
+# Finished async jobs kept for status polling before the oldest are forgotten.
+_MAX_TRACKED_JOBS = 100
+# GCS accepts at most 32 source objects per compose request.
+_MAX_COMPOSE_SOURCES = 32
+_ADAPTIVE_PART_MAX = 64 * 1024 * 1024
+# Resumable upload chunks must be a multiple of 256 KiB.
+_CHUNK_ALIGNMENT = 256 * 1024
+# dbname=... in a libpq conninfo string, bare or single-quoted.
+_CONNINFO_DBNAME = re.compile(r"(?:^|\s)dbname\s*=\s*('(?:[^'\\]|\\.)*'|\S+)")
+# Characters kept from a database name when it becomes a blob path segment.
+_UNSAFE_LABEL_CHARS = re.compile(r"[^A-Za-z0-9._-]+")
+
 
 def _validate_env(db_url, bucket_name):
     if not db_url:
@@ -30,6 +159,72 @@ def _safe_blob_name(prefix, name):
     return f"{prefix.rstrip('/')}/{name.lstrip('/')}"
 
 
+_storage_client_lock = threading.Lock()
+
+
+def _storage_client(pool_size=_MIN_HTTP_POOL_SIZE):
+    """Process-wide GCS client over one pooled, keep-alive HTTP session.
+
+    Credential discovery, token fetches and TLS handshakes happen once rather
+    than per backup, and the connection pool is sized so concurrent part
+    uploads reuse connections instead of opening and discarding extras. The
+    client is built on first use, under a lock so concurrent backups share it.
+    """
+    with _storage_client_lock:
+        return _build_storage_client(pool_size)
+
+
+@functools.lru_cache(maxsize=None)
+def _build_storage_client(pool_size):
+    credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+    session = AuthorizedSession(credentials)
+    session.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+    return storage.Client(project=project, credentials=credentials, _http=session)
+
+
+def _http_pool_size(config):
+    """Connections needed when every backup runs a full set of parallel part uploads."""
+    return max(_MIN_HTTP_POOL_SIZE, config.concurrency * config.parallel_upload_workers)
+
+
+def _resolve_database_urls():
+    """Database URLs to back up: DATABASE_URLS if set, else the single DATABASE_URL."""
+    urls = [u.strip() for u in os.environ.get("DATABASE_URLS", "").splitlines() if u.strip()]
+    return urls or [os.environ.get("DATABASE_URL")]
+
+
+def _database_label(db_url, index):
+    """Credential-free name for a database URL, used in logs and blob paths.
+
+    Only the database name is ever taken from `db_url`, so passwords and
+    other connection parameters cannot leak; without one the label is
+    `database-<index>`.
+    """
+    if not db_url:
+        name = ""
+    elif db_url.startswith(("postgresql://", "postgres://")):
+        name = unquote(urlparse(db_url).path.lstrip("/"))
+    else:
+        match = _CONNINFO_DBNAME.search(db_url)
+        name = re.sub(r"\\(.)", r"\1", match.group(1).strip("'")) if match else ""
+    name = _UNSAFE_LABEL_CHARS.sub("_", name).strip("._")
+    return name or f"database-{index}"
+
+
+def _database_labels(db_urls):
+    """`_database_label` for each URL, suffixed with its position where names repeat.
+
+    The same database name on two clusters (typically `postgres`) would
+    otherwise share one backup folder and be indistinguishable in logs.
+    """
+    labels = [_database_label(db_url, index) for index, db_url in enumerate(db_urls, start=1)]
+    counts = Counter(labels)
+    return [
+        f"{label}-{index}" if counts[label] > 1 else label
+        for index, label in enumerate(labels, start=1)
+    ]
+
+
 def _resolve_compress_setting():
     """Resolve compression toggle with backward compatibility.
 
@@ -42,6 +237,190 @@ def _resolve_compress_setting():
     return True
 
 
+def _resolve_gzip_level():
+    level = _env_int("BACKUP_GZIP_LEVEL", _DEFAULT_GZIP_LEVEL)
+    if not 0 <= level <= 9:
+        raise ValueError("BACKUP_GZIP_LEVEL must be between 0 and 9")
+    return level
+
+
+def _resolve_zstd_level():
+    level = _env_int("BACKUP_ZSTD_LEVEL", _DEFAULT_ZSTD_LEVEL)
+    if not 1 <= level <= _ZSTD_MAX_LEVEL:
+        raise ValueError(f"BACKUP_ZSTD_LEVEL must be between 1 and {_ZSTD_MAX_LEVEL}")
+    return level
+
+
+def _resolve_compressor():
+    name = os.environ.get("BACKUP_COMPRESSOR", "gzip").strip().lower()
+    if name not in _COMPRESSION_SUFFIXES:
+        raise ValueError(f"BACKUP_COMPRESSOR must be one of: {', '.join(_COMPRESSION_SUFFIXES)}")
+    return name
+
+
+def _resolve_dump_format():
+    dump_format = os.environ.get("BACKUP_PG_DUMP_FORMAT", "plain").strip().lower()
+    if dump_format not in _DUMP_FORMATS:
+        raise ValueError(f"BACKUP_PG_DUMP_FORMAT must be one of: {', '.join(_DUMP_FORMATS)}")
+    return dump_format
+
+
+def _resolve_timeout():
+    timeout = _env_int("BACKUP_TIMEOUT_SECONDS", 0)
+    if timeout < 0:
+        raise ValueError("BACKUP_TIMEOUT_SECONDS must be 0 (no limit) or more")
+    return timeout or None
+
+
+def _resolve_non_negative_int(name, default):
+    value = _env_int(name, default)
+    if value < 0:
+        raise ValueError(f"{name} must be 0 or more")
+    return value
+
+
+def _resolve_positive_int(name, default):
+    value = _env_int(name, default)
+    if value < 1:
+        raise ValueError(f"{name} must be at least 1")
+    return value
+
+
+@dataclass(frozen=True)
+class BackupConfig:
+    """Backup settings, resolved from the environment once and shared by every backup.
+
+    Sizes are in bytes and `timeout` in seconds (see BACKUP_TIMEOUT_SECONDS). `db_url` is
+    the database `backup_db` dumps; `db_urls` lists every database
+    `backup_databases` should cover (just `db_url` when empty). Defaults match
+    what `from_env` uses when a variable is unset; `tmpdir=None` means the
+    system temp dir.
+    """
+
+    db_url: Optional[str] = None
+    bucket: Optional[str] = None
+    prefix: str = ""
+    compress: bool = True
+    compressor: str = "gzip"
+    gzip_level: int = _DEFAULT_GZIP_LEVEL
+    zstd_level: int = _DEFAULT_ZSTD_LEVEL
+    external_compressor: bool = False
+    dump_format: str = "plain"
+    pg_dump_path: str = "pg_dump"
+    pg_dump_jobs: int = field(default_factory=lambda: os.cpu_count() or 1)
+    tmpdir: Optional[str] = None
+    timeout: Optional[int] = None
+    chunk_size: int = _DEFAULT_GCS_CHUNK_SIZE_MIB * 1024 * 1024
+    parallel_upload_threshold: int = _DEFAULT_PARALLEL_UPLOAD_THRESHOLD_MIB * 1024 * 1024
+    parallel_upload_part_size: int = _DEFAULT_PARALLEL_UPLOAD_PART_MIB * 1024 * 1024
+    parallel_upload_workers: int = _DEFAULT_PARALLEL_UPLOAD_WORKERS
+    concurrency: int = _DEFAULT_BACKUP_CONCURRENCY
+    db_urls: tuple = ()
+
+    @classmethod
+    def from_env(cls):
+        """Build the config from environment variables, validating every value up front."""
+        db_urls = tuple(_resolve_database_urls())
+        return cls(
+            db_url=db_urls[0],
+            bucket=os.environ.get("BUCKET_NAME"),
+            prefix=os.environ.get("BACKUP_PREFIX", ""),
+            compress=_resolve_compress_setting(),
+            compressor=_resolve_compressor(),
+            gzip_level=_resolve_gzip_level(),
+            zstd_level=_resolve_zstd_level(),
+            external_compressor=_env_bool("BACKUP_EXTERNAL_COMPRESSOR", False),
+            dump_format=_resolve_dump_format(),
+            # Allow overriding pg_dump executable path via env var (helpful on Windows)
+            pg_dump_path=os.environ.get("PG_DUMP_PATH", "pg_dump"),
+            pg_dump_jobs=_resolve_positive_int("BACKUP_PG_DUMP_JOBS", os.cpu_count() or 1),
+            tmpdir=os.environ.get("BACKUP_TMPDIR") or None,
+            timeout=_resolve_timeout(),
+            # A MiB count is always a multiple of the 256 KiB resumable chunk alignment.
+            chunk_size=_resolve_positive_int("GCS_CHUNK_SIZE_MIB", _DEFAULT_GCS_CHUNK_SIZE_MIB) * 1024 * 1024,
+            parallel_upload_threshold=_resolve_non_negative_int(
+                "GCS_PARALLEL_UPLOAD_THRESHOLD_MIB", _DEFAULT_PARALLEL_UPLOAD_THRESHOLD_MIB
+            ) * 1024 * 1024,
+            parallel_upload_part_size=_resolve_positive_int(
+                "GCS_PARALLEL_UPLOAD_PART_MIB", _DEFAULT_PARALLEL_UPLOAD_PART_MIB
+            ) * 1024 * 1024,
+            parallel_upload_workers=_resolve_positive_int(
+                "GCS_PARALLEL_UPLOAD_WORKERS", _DEFAULT_PARALLEL_UPLOAD_WORKERS
+            ),
+            concurrency=_resolve_positive_int("BACKUP_CONCURRENCY", _DEFAULT_BACKUP_CONCURRENCY),
+            db_urls=db_urls,
+        )
+
+    @property
+    def inline_compressor(self):
+        """Compressor applied to the plain-format stream, or None (archive formats compress in pg_dump)."""
+        return self.compressor if self.compress and self.dump_format == "plain" else None
+
+    @property
+    def upload_suffix(self):
+        if self.dump_format != "plain":
+            return _ARCHIVE_SUFFIXES[self.dump_format]
+        return ".sql" + _COMPRESSION_SUFFIXES.get(self.inline_compressor, "")
+
+    @property
+    def content_type(self):
+        if self.dump_format != "plain":
+            return _ARCHIVE_CONTENT_TYPES[self.dump_format]
+        return _CONTENT_TYPES[self.inline_compressor]
+
+
+def _new_compressor(config):
+    """Return a streaming compressor exposing zlib-style compress()/flush()."""
+    if config.compressor == "zstd":
+        try:
+            import zstandard
+        except ImportError as ie:
+            raise RuntimeError("BACKUP_COMPRESSOR=zstd requires the 'zstandard' package") from ie
+        # threads=-1 spreads compression across all available cores.
+        return zstandard.ZstdCompressor(level=config.zstd_level, threads=-1).compressobj()
+    if isal_zlib is not None and config.gzip_level in _ISAL_LEVELS:
+        return isal_zlib.compressobj(config.gzip_level, isal_zlib.DEFLATED, _GZIP_WBITS)
+    return zlib.compressobj(config.gzip_level, wbits=_GZIP_WBITS)
+
+
+def _external_compressor_cmd(config):
+    """Command line for an external compressor fed straight from pg_dump's stdout pipe.
+
+    Returns None when external compression is disabled or the binary is missing,
+    in which case the dump is compressed in-process.
+    """
+    if not config.external_compressor:
+        return None
+    exe = shutil.which(_EXTERNAL_COMPRESSORS[config.compressor])
+    if not exe:
+        logging.warning("%s not found on PATH; compressing in-process", _EXTERNAL_COMPRESSORS[config.compressor])
+        return None
+    if config.compressor == "zstd":
+        return [exe, "-q", "-c", "-T0", f"-{config.zstd_level}"]
+    return [exe, "-c", f"-{config.gzip_level}"]
+
+
+def _command_name(cmd):
+    """Program name of a command line, without the arguments (which may hold credentials)."""
+    return os.path.basename(cmd if isinstance(cmd, str) else cmd[0])
+
+
+def _ensure_dir(path):
+    """Create `path` if needed; None (the system temp dir) is passed through."""
+    if path:
+        os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _pg_dump_compression(config):
+    """pg_dump -Z value matching the configured compressor (archive formats only)."""
+    if not config.compress:
+        return "0"
+    if config.compressor == "zstd":
+        return f"zstd:{config.zstd_level}"
+    return str(config.gzip_level)
+
+
 def _require_backup_token_if_configured():
     """Protect /backup endpoint when BACKUP_API_KEY is configured."""
     expected = os.environ.get("BACKUP_API_KEY")
@@ -54,95 +433,452 @@ def _require_backup_token_if_configured():
     return None
 
 
-def backup_db(db_url=None, bucket_name=None, backup_prefix=None, compress=True):
-    """Create a PostgreSQL dump and upload it to GCS.
+class _DumpStream:
+    """Readable stream over pg_dump's stdout, compressed on the fly if requested.
+
+    Exposes the ``read``/``tell`` interface google-cloud-storage needs for a
+    resumable upload of unknown size, so the dump flows straight to GCS without
+    touching local disk. Compression happens either in-process (`compressor`)
+    or in an external `filter_cmd` that reads pg_dump's stdout pipe directly.
+    Every process's exit status is checked once the output is exhausted, which
+    makes a failed dump raise before the upload is finalized.
+
+    `timeout` (seconds, None for no limit) kills the whole pipeline. The
+    processes can only run ahead of the consumer by a pipe buffer, so the
+    deadline effectively covers reading the stream too, not just producing it.
+    """
+
+    def __init__(self, cmd, compressor=None, filter_cmd=None, tmpdir=None, timeout=None):
+        self._timeout = timeout
+        self._compressor = compressor
+        self._buffer = bytearray()
+        self._position = 0
+        self._eof = False
+        self.bytes_read = 0
+        # Stage timings (time.monotonic_ns) for profiling: when the dump started and
+        # finished, and how long was spent inside the in-process compressor.
+        self.started_ns = time.monotonic_ns()
+        self.finished_ns = None
+        self.compress_ns = 0
+
+        self._timed_out = threading.Event()
+        self._timer = None
+        if timeout:
+            self._timer = threading.Timer(timeout, self._kill_on_timeout)
+            self._timer.daemon = True
+
+        # stderr goes to an anonymous file so a chatty pg_dump can never block on a full pipe.
+        self._stderr = tempfile.TemporaryFile(dir=_ensure_dir(tmpdir))
+        self._procs = []
+        try:
+            # A buffered stdout makes read(_READ_SIZE) block until a full block (or EOF) arrives.
+            self._procs.append(
+                subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=self._stderr, bufsize=_READ_SIZE)
+            )
+            if filter_cmd:
+                dump_out = self._procs[0].stdout
+                self._procs.append(
+                    subprocess.Popen(
+                        filter_cmd, stdin=dump_out, stdout=subprocess.PIPE, stderr=self._stderr, bufsize=_READ_SIZE
+                    )
+                )
+                # Only the filter should hold the read end, so it sees EOF when pg_dump exits.
+                dump_out.close()
+        except Exception:
+            self.close()
+            raise
+        self._output = self._procs[-1].stdout
+        if self._timer:
+            self._timer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _kill_on_timeout(self):
+        for proc in self._procs:
+            # Only a process still running when the deadline hits counts as timed out.
+            if proc.poll() is None:
+                self._timed_out.set()
+                proc.kill()
+
+    def _finish(self):
+        if self._timer:
+            self._timer.cancel()
+        returncodes = [proc.wait() for proc in self._procs]
+        self.finished_ns = time.monotonic_ns()
+        if self._timed_out.is_set():
+            pipeline = " | ".join(_command_name(proc.args) for proc in self._procs)
+            raise subprocess.TimeoutExpired(pipeline, self._timeout)
+        # Report the first failing stage; pg_dump failing usually makes the filter fail too.
+        for proc, returncode in zip(self._procs, returncodes):
+            if returncode != 0:
+                self._stderr.seek(0)
+                stderr = self._stderr.read().decode("utf-8", errors="replace")
+                raise subprocess.CalledProcessError(returncode, _command_name(proc.args), stderr=stderr)
+
+    def read(self, size=-1):
+        # Resumable uploads treat a short read as end-of-stream, so fill the request fully.
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            chunk = self._output.read(_READ_SIZE)
+            if chunk:
+                self.bytes_read += len(chunk)
+                if self._compressor:
+                    compress_start = time.monotonic_ns()
+                    self._buffer += self._compressor.compress(chunk)
+                    self.compress_ns += time.monotonic_ns() - compress_start
+                else:
+                    self._buffer += chunk
+                continue
+            if self._compressor:
+                compress_start = time.monotonic_ns()
+                self._buffer += self._compressor.flush()
+                self.compress_ns += time.monotonic_ns() - compress_start
+            self._eof = True
+            self._finish()
+
+        if size is None or size < 0:
+            size = len(self._buffer)
+        # Copy out through a view: slicing the bytearray first would copy the data twice.
+        with memoryview(self._buffer) as view:
+            data = bytes(view[:size])
+        del self._buffer[:size]
+        self._position += len(data)
+        return data
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+        for proc in self._procs:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            proc.stdout.close()
+        self._stderr.close()
+
+
+class _BufferedParts:
+    """Readable stream over parts already read into memory, consumed as it is read.
+
+    A read covering exactly one part returns that part without copying.
+    """
+
+    def __init__(self, parts):
+        self._parts = parts
+        self._position = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = sum(len(part) for part in self._parts)
+        chunks = []
+        while self._parts and size > 0:
+            part = self._parts.popleft()
+            if len(part) > size:
+                self._parts.appendleft(part[size:])
+                part = part[:size]
+            chunks.append(part)
+            size -= len(part)
+        data = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+        self._position += len(data)
+        return data
+
+    def tell(self):
+        return self._position
+
+
+def _delete_blobs(blobs):
+    for blob in blobs:
+        try:
+            blob.delete()
+        except Exception:
+            # A leaked part sits next to real backups, so make sure it gets noticed.
+            logging.warning("Failed to remove temporary blob %s", blob.name, exc_info=True)
+
+
+def _compose_parts(executor, bucket, blob, parts, temp_blobs):
+    """Compose `parts` into `blob`, 32 sources at a time.
+
+    Larger part lists are composed level by level into intermediate objects,
+    which are appended to `temp_blobs` so the caller can remove them.
+    """
+    level = 0
+    while len(parts) > _MAX_COMPOSE_SOURCES:
+        groups = [parts[i:i + _MAX_COMPOSE_SOURCES] for i in range(0, len(parts), _MAX_COMPOSE_SOURCES)]
+        merged = [bucket.blob(f"{blob.name}.compose{level}-{i:03d}") for i in range(len(groups))]
+        temp_blobs.extend(merged)
+        list(executor.map(lambda target, group: target.compose(group), merged, groups))
+        parts = merged
+        level += 1
+    blob.compose(parts)
+
+
+def _aligned_chunk_size(size):
+    """Smallest valid resumable chunk size that sends `size` bytes in one request."""
+    return -(-size // _CHUNK_ALIGNMENT) * _CHUNK_ALIGNMENT
+
+
+def _parallel_composite_upload(bucket, blob, buffered, stream, part_size, workers):
+    """Upload the parts in `buffered`, then the rest of `stream`, as parallel parts composed into `blob`.
+
+    `buffered` is a deque of parts already read from `stream`; it is emptied as
+    they are submitted, so none outlives its upload.
+
+    The dump's final size is unknown while streaming, so part size adapts as it
+    grows: it starts at `part_size` and doubles every `_MAX_COMPOSE_SOURCES`
+    parts up to `_ADAPTIVE_PART_MAX` (or `part_size` if larger). At most
+    `workers` parts are in flight, so every worker stays busy as parts grow
+    and memory stays bounded by `workers` times the largest part.
+    """
+    parts = []
+    pending = deque()
+    max_part_size = max(part_size, _ADAPTIVE_PART_MAX)
+
+    def upload_part(part_blob, data):
+        # A BytesIO over bytes shares the buffer, and a single chunk reads it back without a copy.
+        part_blob.chunk_size = _aligned_chunk_size(len(data))
+        part_blob.upload_from_file(io.BytesIO(data), size=len(data))
+
+    def next_part_size():
+        return min(max_part_size, part_size << (len(parts) // _MAX_COMPOSE_SOURCES))
+
+    def submit(data):
+        part_blob = bucket.blob(f"{blob.name}.part{len(parts):03d}")
+        parts.append(part_blob)
+        while len(pending) >= workers:
+            pending.popleft().result()
+        pending.append(executor.submit(upload_part, part_blob, data))
+
+    temp_blobs = []
+    with contextlib.ExitStack() as cleanup:
+        # Callbacks run in reverse: stop in-flight uploads first, then delete whatever was written.
+        cleanup.callback(lambda: _delete_blobs(parts + temp_blobs))
+        executor = ThreadPoolExecutor(max_workers=workers)
+        cleanup.callback(executor.shutdown, wait=True, cancel_futures=True)
+
+        while buffered:
+            submit(buffered.popleft())
+        while True:
+            data = stream.read(next_part_size())
+            if not data:
+                break
+            submit(data)
+        while pending:
+            pending.popleft().result()
+
+        logging.info("Composing %d parts into gs://%s/%s", len(parts), bucket.name, blob.name)
+        _compose_parts(executor, bucket, blob, parts, temp_blobs)
+
+
+def _upload_stream(bucket, blob, stream, config):
+    """Upload `stream` to `blob`, switching to a parallel composite upload for large backups.
+
+    Memory use is about one resumable chunk (`chunk_size`) for a single-stream
+    upload. With composite uploads on, up to `parallel_upload_threshold` bytes
+    are buffered to decide; a composite upload then holds the part being read
+    and one part per worker in flight: about 288 MiB per backup with the
+    defaults, rising to about 576 MiB once parts have grown to 64 MiB.
+    """
+    threshold = config.parallel_upload_threshold
+    if threshold <= 0:
+        blob.upload_from_file(stream)
+        return
+
+    # Buffer part by part until the backup either ends or crosses the threshold.
+    part_size = config.parallel_upload_part_size
+    buffered = deque()
+    buffered_size = 0
+    eof = False
+    while not eof and buffered_size <= threshold:
+        data = stream.read(part_size)
+        eof = len(data) < part_size
+        if data:
+            buffered.append(data)
+            buffered_size += len(data)
+    del data
+
+    if buffered_size <= threshold:
+        # Small enough for a single object; each chunk hands out one buffered part as-is.
+        blob.chunk_size = _aligned_chunk_size(part_size)
+        blob.upload_from_file(_BufferedParts(buffered), size=buffered_size)
+        return
+
+    _parallel_composite_upload(bucket, blob, buffered, stream, part_size, config.parallel_upload_workers)
+
+
+def _log_duration(stage, dur_ns, size):
+    """Emit one structured timing record; returns the duration in milliseconds."""
+    dur_ms = dur_ns // 1_000_000
+    logging.info("stage=%s dur_ms=%d bytes=%d", stage, dur_ms, size)
+    return dur_ms
+
+
+def _log_stage(stage, start_ns, end_ns, size):
+    """`_log_duration` for a stage that ran from `start_ns` to `end_ns`."""
+    return _log_duration(stage, end_ns - start_ns, size)
+
+
+def backup_db(config=None, client=None):
+    """Stream a PostgreSQL dump straight into GCS.
+
+    pg_dump's stdout is compressed in memory and fed to a resumable upload, so
+    no temporary copy of the dump is ever written to local disk. The directory
+    format is the exception: pg_dump needs a real directory to dump into in
+    parallel, which is then streamed up as a tar archive.
 
     Args:
-        db_url (str): Database URL/URI. If None, read from env `DATABASE_URL`.
-        bucket_name (str): GCS bucket name. If None, read from env `BUCKET_NAME`.
-        backup_prefix (str): Optional prefix/path inside the bucket.
-        compress (bool): Whether to gzip the SQL output before upload.
+        config (BackupConfig): What to back up and how. If None, built from the
+            environment with `BackupConfig.from_env()`.
+        client (storage.Client): GCS client to upload with. If None, a shared
+            process-wide client is used.
 
     Returns:
-        dict: info about the uploaded backup (bucket, blob_name, size_bytes).
+        dict: info about the uploaded backup (bucket, blob_name, size_bytes) and
+        per-stage timings in milliseconds. Stages overlap while streaming:
+        `dump` runs until pg_dump exits, `compress` is time spent in the
+        in-process compressor, `upload` covers the whole transfer.
     """
-    db_url = db_url or os.environ.get("DATABASE_URL")
-    bucket_name = bucket_name or os.environ.get("BUCKET_NAME")
-    backup_prefix = backup_prefix or os.environ.get("BACKUP_PREFIX", "")
-
-    _validate_env(db_url, bucket_name)
+    started_ns = time.monotonic_ns()
+    config = config or BackupConfig.from_env()
+    _validate_env(config.db_url, config.bucket)
 
     # Include milliseconds + short UUID to avoid collisions even for same-second runs.
     now_utc = datetime.now(timezone.utc)
     timestamp = now_utc.strftime("%Y%m%d-%H%M%S")
     ms = int(now_utc.microsecond / 1000)
     unique_suffix = uuid.uuid4().hex[:8]
-    base_name = f"backup-{timestamp}-{ms:03d}-{unique_suffix}.sql"
-    upload_name = base_name + (".gz" if compress else "")
-
-    # Create a temporary file for the dump
-    tmp_sql = tempfile.NamedTemporaryFile(delete=False, suffix=".sql")
-    tmp_sql.close()
-
-    try:
-        logging.info("Running pg_dump")
-        # Allow overriding pg_dump executable path via env var (helpful on Windows)
-        pg_dump_cmd = os.environ.get("PG_DUMP_PATH", "pg_dump")
-        # Use --dbname to accept a full DATABASE_URL/URI
-        cmd = [pg_dump_cmd, "--dbname", db_url, "-f", tmp_sql.name]
+    upload_name = f"backup-{timestamp}-{ms:03d}-{unique_suffix}{config.upload_suffix}"
+
+    client = client or _storage_client(_http_pool_size(config))
+    bucket = client.bucket(config.bucket)
+    blob_name = _safe_blob_name(config.prefix, upload_name)
+    blob = bucket.blob(blob_name)
+    # The chunk size applies to single-stream uploads (composite uploads off).
+    blob.chunk_size = config.chunk_size
+    # Label the payload with its real type and no Content-Encoding: compressed dumps are
+    # stored and served byte-for-byte instead of being gzip-transcoded by GCS.
+    blob.content_type = config.content_type
+    blob.content_encoding = None
+
+    # Use --dbname to accept a full DATABASE_URL/URI
+    cmd = [config.pg_dump_path, "--dbname", config.db_url]
+    if config.dump_format == "custom":
+        cmd += ["-Fc", "-Z", _pg_dump_compression(config)]
+
+    filter_cmd = _external_compressor_cmd(config) if config.inline_compressor else None
+    compressor = _new_compressor(config) if config.inline_compressor and not filter_cmd else None
+    dump_dir = None
+    timings_ms = {}
+
+    # Each local resource registers its cleanup as soon as it exists, so every exit path releases it.
+    with contextlib.ExitStack() as cleanup:
         try:
-            subprocess.run(cmd, check=True, capture_output=True, text=True, timeout=600)
-        except FileNotFoundError as fnf:
-            logging.error("pg_dump executable not found: %s", pg_dump_cmd)
-            logging.error("On Windows install PostgreSQL client or set PG_DUMP_PATH to the pg_dump executable path.")
-            raise RuntimeError(f"pg_dump not found: {pg_dump_cmd}") from fnf
+            logging.info("Running pg_dump (%s format)", config.dump_format)
+            try:
+                if config.dump_format == "directory":
+                    dump_dir = tempfile.mkdtemp(prefix="pg_dump-", dir=_ensure_dir(config.tmpdir))
+                    cleanup.callback(shutil.rmtree, dump_dir, ignore_errors=True)
+                    cmd += ["-Fd", "-j", str(config.pg_dump_jobs), "-Z", _pg_dump_compression(config), "-f", dump_dir]
+                    dump_start = time.monotonic_ns()
+                    try:
+                        subprocess.run(
+                            cmd, check=True, capture_output=True, text=True,
+                            timeout=config.timeout or _PG_DUMP_TIMEOUT_SECONDS,
+                        )
+                    except subprocess.CalledProcessError as e:
+                        # The full command line carries the database URL; report only the program.
+                        raise subprocess.CalledProcessError(
+                            e.returncode, _command_name(cmd), stderr=e.stderr
+                        ) from None
+                    except subprocess.TimeoutExpired as te:
+                        raise subprocess.TimeoutExpired(_command_name(cmd), te.timeout) from None
+                    timings_ms["dump"] = _log_stage("dump", dump_start, time.monotonic_ns(), _dir_size(dump_dir))
+                else:
+                    stream = cleanup.enter_context(
+                        _DumpStream(
+                            cmd, compressor=compressor, filter_cmd=filter_cmd, tmpdir=config.tmpdir,
+                            timeout=config.timeout,
+                        )
+                    )
+            except FileNotFoundError as fnf:
+                logging.error("pg_dump executable not found: %s", config.pg_dump_path)
+                logging.error(
+                    "On Windows install PostgreSQL client or set PG_DUMP_PATH to the pg_dump executable path."
+                )
+                raise RuntimeError(f"pg_dump not found: {config.pg_dump_path}") from fnf
+
+            if dump_dir:
+                # The directory's files are already compressed by pg_dump; tar only bundles them.
+                # No deadline here: tar waits on the upload, which has its own HTTP timeouts.
+                stream = cleanup.enter_context(
+                    _DumpStream(["tar", "-C", dump_dir, "-cf", "-", "."], tmpdir=config.tmpdir)
+                )
+
+            logging.info("Streaming dump to gs://%s/%s", config.bucket, blob_name)
+            upload_start = time.monotonic_ns()
+            _upload_stream(bucket, blob, stream, config)
+            upload_end = time.monotonic_ns()
+            size = stream.tell()
+
+            if not dump_dir:
+                # With an external compressor the stream only sees compressed bytes, so report both as one stage.
+                stage = "dump_compress" if filter_cmd else "dump"
+                timings_ms[stage] = _log_stage(stage, stream.started_ns, stream.finished_ns, stream.bytes_read)
+            if compressor:
+                timings_ms["compress"] = _log_duration("compress", stream.compress_ns, size)
+            timings_ms["upload"] = _log_stage("upload", upload_start, upload_end, size)
+            timings_ms["total"] = _log_stage("total", started_ns, time.monotonic_ns(), size)
+            logging.info("Upload complete: gs://%s/%s (%d bytes)", config.bucket, blob_name, size)
+
+            return {"bucket": config.bucket, "blob": blob_name, "size": size, "timings_ms": timings_ms}
+
         except subprocess.TimeoutExpired as te:
-            logging.error("pg_dump timed out after %s seconds", te.timeout)
-            raise RuntimeError("pg_dump timed out") from te
-
-        upload_path = tmp_sql.name
-        if compress:
-            gz_path = tempfile.NamedTemporaryFile(delete=False, suffix=".sql.gz")
-            gz_path.close()
-            logging.info("Compressing dump to %s", gz_path.name)
-            with open(tmp_sql.name, "rb") as f_in, gzip.open(gz_path.name, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
-            upload_path = gz_path.name
-
-        # Upload to GCS
-        client = storage.Client()
-        bucket = client.bucket(bucket_name)
-        blob_name = _safe_blob_name(backup_prefix, upload_name)
-        blob = bucket.blob(blob_name)
-
-        logging.info("Uploading %s to gs://%s/%s", upload_path, bucket_name, blob_name)
-        blob.upload_from_filename(upload_path)
-
-        size = os.path.getsize(upload_path)
-        logging.info("Upload complete (%d bytes)", size)
-
-        return {"bucket": bucket_name, "blob": blob_name, "size": size}
-
-    except subprocess.CalledProcessError as e:
-        stderr = (e.stderr or "").strip()
-        if stderr:
-            logging.error("pg_dump stderr: %s", stderr)
-        logging.exception("pg_dump failed: %s", e)
-        raise
-    finally:
-        # Cleanup temporary files
+            logging.error("%s timed out after %s seconds", te.cmd, te.timeout)
+            raise RuntimeError(f"{te.cmd} timed out") from te
+        except subprocess.CalledProcessError as e:
+            stderr = (e.stderr or "").strip()
+            if stderr:
+                logging.error("%s stderr: %s", e.cmd, stderr)
+            logging.exception("%s failed: %s", e.cmd, e)
+            raise
+
+
+def _dir_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def backup_databases(config, client=None):
+    """Back up every database in `config.db_urls` concurrently with `backup_db`.
+
+    pg_dump runs in a subprocess and uploads are network-bound, so a small
+    thread pool (BACKUP_CONCURRENCY) overlaps them well. Each database goes
+    under its own `<prefix>/<database name>/` path, with `-<n>` appended for
+    the n-th URL when several name the same database (`database-<n>` when it
+    names none).
+
+    Returns:
+        list: one dict per database, in input order: the `backup_db` result, or
+        `{"error": ...}` if that backup failed. Both carry a `database` label.
+    """
+
+    def run(label, db_url):
+        db_config = replace(config, db_url=db_url, prefix=_safe_blob_name(config.prefix, label))
         try:
-            if os.path.exists(tmp_sql.name):
-                os.remove(tmp_sql.name)
-        except Exception:
-            logging.debug("Failed to remove temp sql file", exc_info=True)
+            result = backup_db(db_config, client=client)
+        except Exception as e:
+            logging.error("Backup of %s failed: %s", label, e)
+            return {"database": label, "error": str(e)}
+        result["database"] = label
+        return result
 
-        if compress:
-            try:
-                if 'gz_path' in locals() and os.path.exists(gz_path.name):
-                    os.remove(gz_path.name)
-            except Exception:
-                logging.debug("Failed to remove temp gz file", exc_info=True)
+    db_urls = config.db_urls or (config.db_url,)
+    client = client or _storage_client(_http_pool_size(config))
+    with ThreadPoolExecutor(max_workers=min(config.concurrency, len(db_urls))) as executor:
+        return list(executor.map(run, _database_labels(db_urls), db_urls))
 
 
 def _env_bool(name, default=True):
@@ -152,14 +888,31 @@ def _env_bool(name, default=True):
     return str(v).lower() not in ("0", "false", "no", "n")
 
 
+def _env_int(name, default):
+    v = os.environ.get(name)
+    if v is None or not str(v).strip():
+        return default
+    try:
+        return int(v)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, got {v!r}") from None
+
+
 def main():
-    db_url = os.environ.get("DATABASE_URL")
-    bucket = os.environ.get("BUCKET_NAME")
-    prefix = os.environ.get("BACKUP_PREFIX")
-    compress = _resolve_compress_setting()
+    config = BackupConfig.from_env()
+
+    if len(config.db_urls) > 1:
+        results = backup_databases(config)
+        failed = [r["database"] for r in results if "error" in r]
+        for r in results:
+            if "error" not in r:
+                logging.info("Backup successful: gs://%s/%s", r["bucket"], r["blob"])
+        if failed:
+            raise RuntimeError(f"Backup failed for: {', '.join(failed)}")
+        return
 
     try:
-        result = backup_db(db_url=db_url, bucket_name=bucket, backup_prefix=prefix, compress=compress)
+        result = backup_db(config)
         logging.info("Backup successful: gs://%s/%s", result["bucket"], result["blob"])
     except Exception as e:
         logging.error("Backup failed: %s", e)
@@ -168,6 +921,52 @@ def main():
 
 def create_app():
     app = Flask(__name__)
+    app.config["BACKUP_CONFIG"] = config = BackupConfig.from_env()
+    # Left as None, the shared GCS client is built on the first backup, so the app (and its
+    # health check) starts even where no credentials are available yet.
+    app.config["GCS_CLIENT"] = None
+
+    run_async = _env_bool("BACKUP_ASYNC", False)
+    executor = None
+    if run_async:
+        # One job at a time: a multi-database job already runs BACKUP_CONCURRENCY backups itself.
+        executor = ThreadPoolExecutor(max_workers=1)
+    jobs = {}
+    jobs_lock = threading.Lock()
+    pending_job_id = None
+
+    def run_backup():
+        """Run a backup with the app's config; returns (response body, HTTP status)."""
+        try:
+            started_at = time.monotonic()
+            if len(config.db_urls) > 1:
+                results = backup_databases(config, client=app.config["GCS_CLIENT"])
+                duration_seconds = time.monotonic() - started_at
+                status = 500 if any("error" in r for r in results) else 200
+                return {"backups": results, "duration_seconds": round(duration_seconds, 3)}, status
+
+            result = backup_db(config, client=app.config["GCS_CLIENT"])
+            duration_seconds = time.monotonic() - started_at
+            result["duration_seconds"] = round(duration_seconds, 3)
+            return result, 200
+        except Exception as e:
+            logging.exception("Backup failed via HTTP: %s", e)
+            return {"error": str(e)}, 500
+
+    def run_job(job_id):
+        with jobs_lock:
+            jobs[job_id]["status"] = "running"
+        return run_backup()
+
+    def record_job(job_id, future):
+        nonlocal pending_job_id
+        body, status = future.result()
+        with jobs_lock:
+            jobs[job_id] = {"job_id": job_id, "status": "succeeded" if status == 200 else "failed", "result": body}
+            pending_job_id = None
+            finished = [jid for jid, job in jobs.items() if job["status"] not in ("queued", "running")]
+            for jid in finished[:max(0, len(finished) - _MAX_TRACKED_JOBS)]:
+                del jobs[jid]
 
     @app.route("/", methods=["GET"])
     def health():
@@ -179,16 +978,34 @@ def create_app():
         if auth_error:
             return auth_error
 
-        # Trigger a backup using environment variables only.
-        try:
-            started_at = datetime.now(timezone.utc)
-            result = backup_db(compress=_resolve_compress_setting())
-            duration_seconds = (datetime.now(timezone.utc) - started_at).total_seconds()
-            result["duration_seconds"] = round(duration_seconds, 3)
-            return jsonify(result), 200
-        except Exception as e:
-            logging.exception("Backup failed via HTTP: %s", e)
-            return jsonify({"error": str(e)}), 500
+        # Trigger a backup using the settings loaded from the environment at startup.
+        if not run_async:
+            body, status = run_backup()
+            return jsonify(body), status
+
+        nonlocal pending_job_id
+        with jobs_lock:
+            if pending_job_id is not None:
+                # Point the caller at the backup already on its way instead of stacking another.
+                body = dict(jobs[pending_job_id], error="A backup is already queued or running")
+                return jsonify(body), 409, {"Location": f"/backup/{pending_job_id}"}
+            job_id = pending_job_id = uuid.uuid4().hex
+            jobs[job_id] = {"job_id": job_id, "status": "queued"}
+        future = executor.submit(run_job, job_id)
+        future.add_done_callback(lambda f: record_job(job_id, f))
+        return jsonify({"job_id": job_id, "status": "queued"}), 202, {"Location": f"/backup/{job_id}"}
+
+    @app.route("/backup/<job_id>", methods=["GET"])
+    def backup_status(job_id):
+        auth_error = _require_backup_token_if_configured()
+        if auth_error:
+            return auth_error
+
+        with jobs_lock:
+            job = jobs.get(job_id)
+        if job is None:
+            return jsonify({"error": "Unknown job"}), 404
+        return jsonify(job), 200
 
     return app
 
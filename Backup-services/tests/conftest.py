@@ -0,0 +1,5 @@
+import os
+import sys
+
+# app.py is a standalone script, not a package; make it importable as `app`.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))